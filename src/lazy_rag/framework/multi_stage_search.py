@@ -1,8 +1,20 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
+import array
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import Future, wait
 from dataclasses import dataclass, field
-from typing import Any, NotRequired, Protocol, TypedDict, cast, runtime_checkable
+from pathlib import Path
+from typing import Any, NamedTuple, NotRequired, Protocol, TypedDict, cast, runtime_checkable
 
 
 class ServerConfig(TypedDict):
@@ -23,17 +35,42 @@ class WorkflowConfig(TypedDict):
     nodes: list[SearchNodeConfig]
 
 
+class _EmptyPayload(Mapping[str, object]):
+    """payload 省略時に共有する空の読み取り専用 Mapping（ヒット毎に dict を作らない）"""
+
+    __slots__ = ()
+
+    def __getitem__(self, key: str) -> object:
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+    def __repr__(self) -> str:
+        return "{}"
+
+    def __reduce__(self) -> str:
+        # pickle 後も同じシングルトンを指す
+        return "_EMPTY_PAYLOAD"
+
+
+_EMPTY_PAYLOAD: Mapping[str, object] = _EmptyPayload()
+
+
 @dataclass(frozen=True, slots=True)
 class SearchHit:
     doc_id: str
     score: float
-    payload: dict[str, object] = field(default_factory=dict)  # サーバー固有の情報
+    payload: Mapping[str, object] = field(default_factory=lambda: _EMPTY_PAYLOAD)  # サーバー固有の情報
 
 
 class Entry(TypedDict):
     source_server: str
     source_id: str
-    payload: dict[str, object]  # サーバー毎に異なる詳細を保持
+    payload: Mapping[str, object]  # サーバー毎に異なる詳細を保持
 
 
 @dataclass(slots=True)
@@ -47,6 +84,13 @@ class ServerAction:
 @dataclass(slots=True)
 class ServerLog:
     actions: list[ServerAction] = field(default_factory=list)
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+    def merge(self, other: ServerLog) -> None:
+        self.actions.extend(other.actions)
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
 
 
 @runtime_checkable
@@ -77,11 +121,79 @@ class SearchServer(Protocol):
         pass
 
 
-@dataclass(frozen=True, slots=True)
+class BatchSearchServer(SearchServer, Protocol):
+    """複数クエリをまとめて検索できるサーバー（任意）"""
+
+    def search_batch(
+        self,
+        queries: Sequence[str],
+        topks: Sequence[int],
+    ) -> list[list[SearchHit]]:
+        pass
+
+
+class AsyncIngestServer(SearchServer, Protocol):
+    """add_entries の完了を待たずに検索できるサーバー（任意）
+
+    add_entries_async は登録を開始した上で、その完了を表す Future を返す。
+    barrier（任意）は開始済みの登録について、search が一貫した状態で実行できるまで待つ。
+    """
+
+    def add_entries_async(self, entries: Sequence[Entry]) -> Future[None]:
+        pass
+
+    def barrier(self) -> None:
+        pass
+
+
+@dataclass(frozen=True, slots=True, init=False)
 class NodeOutput:
+    # ヒットは列ごとに保持する（scores は float の配列で省メモリ）
     node_name: str
     server_name: str
-    hits: list[SearchHit]
+    doc_ids: list[str]
+    scores: array.array[float]
+    payloads: list[Mapping[str, object]]
+
+    def __init__(
+        self,
+        node_name: str,
+        server_name: str,
+        hits: Sequence[SearchHit] | None = None,
+        *,
+        doc_ids: list[str] | None = None,
+        scores: array.array[float] | None = None,
+        payloads: list[Mapping[str, object]] | None = None,
+    ) -> None:
+        # 従来通り hits から、または列を直接指定して作る
+        if hits is not None:
+            if doc_ids is not None or scores is not None or payloads is not None:
+                raise TypeError("specify either hits or doc_ids/scores/payloads")
+            doc_ids = [hit.doc_id for hit in hits]
+            scores = array.array("d", [hit.score for hit in hits])
+            payloads = [hit.payload for hit in hits]
+        elif doc_ids is None or scores is None or payloads is None:
+            raise TypeError("hits or doc_ids/scores/payloads is required")
+        object.__setattr__(self, "node_name", node_name)
+        object.__setattr__(self, "server_name", server_name)
+        object.__setattr__(self, "doc_ids", doc_ids)
+        object.__setattr__(self, "scores", scores)
+        object.__setattr__(self, "payloads", payloads)
+
+    @classmethod
+    def from_hits(cls, node_name: str, server_name: str, hits: Sequence[SearchHit]) -> NodeOutput:
+        return cls(node_name, server_name, hits)
+
+    @property
+    def hits(self) -> list[SearchHit]:
+        """列から SearchHit のリストを組み立てる。
+
+        アクセス毎に新しいリストを作るため、ループ内では doc_ids / scores / payloads を直接使う。
+        """
+        return [
+            SearchHit(doc_id=doc_id, score=score, payload=payload)
+            for doc_id, score, payload in zip(self.doc_ids, self.scores, self.payloads)
+        ]
 
 
 @dataclass(slots=True)
@@ -101,17 +213,18 @@ class SearchNode:
 
     @classmethod
     def load_from_config(cls, config: SearchNodeConfig) -> SearchNode:
+        # 大量のノードを読み込むため、isinstance ではなく型の一致で検査する
         topk = config.get("topk", 10)
-        if not isinstance(topk, int):
+        if type(topk) is not int:
             raise TypeError("topk must be int")
 
         from_nodes = config.get("from_nodes", [])
-        if not isinstance(from_nodes, list) or not all(isinstance(x, str) for x in from_nodes):
+        if type(from_nodes) is not list or not set(map(type, from_nodes)) <= {str}:
             raise TypeError("from_nodes must be list[str]")
 
         name = config["name"]
         server_name = config["server_name"]
-        if not isinstance(name, str) or not isinstance(server_name, str):
+        if not (type(name) is str and type(server_name) is str):
             raise TypeError("name/server_name must be str")
         return cls(
             name=name,
@@ -136,10 +249,94 @@ class ServerRegistry:
             raise KeyError(f"unregistered server type: {server_type}") from e
 
 
+# キャッシュ対象の構造を変えたら上げる
+_SEARCH_CACHE_VERSION = 1
+
+_SEARCH_SERVER_ATTRS = ("name", "type", "add_entries", "search", "model_dump", "load_from_config")
+_search_server_types = set[type]()
+
+
+def _is_search_server(server: object) -> bool:
+    # runtime_checkable な isinstance は遅いため、型毎に一度だけ属性を確認する
+    server_type = type(server)
+    if server_type in _search_server_types:
+        return True
+    if not all(hasattr(server, attr) for attr in _SEARCH_SERVER_ATTRS):
+        return False
+    _search_server_types.add(server_type)
+    return True
+
+
+class _StageCache:
+    """ノード単位の検索結果を保持する LRU キャッシュ（スレッドセーフ）
+
+    呼び出し側が結果の列を書き換えてもキャッシュに影響しないよう、出し入れの度に列をコピーする。
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._data = OrderedDict[bytes, NodeOutput]()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> NodeOutput | None:
+        with self._lock:
+            out = self._data.get(key)
+            if out is None:
+                return None
+            self._data.move_to_end(key)
+        return self._copy(out)
+
+    def put(self, key: bytes, out: NodeOutput) -> None:
+        out = self._copy(out)
+        with self._lock:
+            self._data[key] = out
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    @staticmethod
+    def _copy(out: NodeOutput) -> NodeOutput:
+        return NodeOutput(
+            out.node_name,
+            out.server_name,
+            doc_ids=list(out.doc_ids),
+            scores=array.array("d", out.scores),
+            payloads=list(out.payloads),
+        )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _StreamItem(NamedTuple):
+    query: Any
+    trace_index: dict[str, NodeOutput]
+    log: ServerLog
+    sent: set[tuple[str, str, str]]
+    interned: dict[str, str]
+
+
+_STREAM_END = object()
+
+
 class Workflow:
-    def __init__(self) -> None:
+    def __init__(self, *, cache: bool = False, cache_size: int = 1024) -> None:
         self._servers: dict[str, SearchServer] = {}
         self._nodes: list[SearchNode] = []
+        self._node_names: set[str] = set()
+        # ステージ単位の検索結果キャッシュ（cache=True で有効化）
+        # キーはサーバーの内部状態を含まないため、add_entries 以外でサーバーを更新したら clear_cache を呼ぶ
+        self._stage_cache = _StageCache(cache_size) if cache else None
+        # サーバー設定のハッシュ（add 時に一度だけ計算する）
+        self._server_digests: dict[str, bytes] = {}
+
+    def clear_cache(self) -> None:
+        if self._stage_cache is not None:
+            self._stage_cache.clear()
 
     def add(
         self,
@@ -150,10 +347,12 @@ class Workflow:
         from_nodes: Sequence[str],
         topk: int,
     ) -> None:
-        assert isinstance(server, SearchServer), "server must implement SearchServer"
+        assert _is_search_server(server), "server must implement SearchServer"
         if server.name in self._servers:
             if self._servers[server.name] is not server:
                 raise ValueError(f"duplicate server name: {server.name}")
+        else:
+            self._server_digests[server.name] = hashlib.blake2b(repr(server.model_dump()).encode()).digest()
 
         self._servers[server.name] = server
         name = node_name or server.name
@@ -163,19 +362,194 @@ class Workflow:
             topk=topk,
             from_nodes=list(from_nodes),
         )
-        assert all(n.name != name for n in self._nodes), f"duplicate node name: {name}"
+        assert name not in self._node_names, f"duplicate node name: {name}"
         self._nodes.append(node)
+        self._node_names.add(name)
 
     def search(self, query: Any) -> tuple[NodeOutput, list[NodeOutput], ServerLog]:
         assert self._nodes, "no nodes in workflow"
         trace = list[NodeOutput]()
+        trace_index = dict[str, NodeOutput]()
         log = ServerLog()
+        sent = set[tuple[str, str, str]]()
+        interned = dict[str, str]()
         out: NodeOutput
-        for node in self._nodes:
-            out = self._exec_search(node, query, trace, log)
-            trace.append(out)
+        for batch in self._search_batches(self._nodes):
+            for out in self._exec_batch(batch, query, trace_index, log, sent, interned):
+                trace.append(out)
+                trace_index[out.node_name] = out
         return out, trace, log
 
+    @staticmethod
+    def _search_batches(nodes: Sequence[SearchNode]) -> list[list[SearchNode]]:
+        # 同じサーバーが連続する場合、from_nodes を持たない後続ノードは先頭ノードとまとめて検索できる
+        batches = list[list[SearchNode]]()
+        for node in nodes:
+            if batches and not node.from_nodes and batches[-1][0].server_name == node.server_name:
+                batches[-1].append(node)
+            else:
+                batches.append([node])
+        return batches
+
+    def search_cached(self, query: Any, *, cache_dir: Path) -> tuple[NodeOutput, list[NodeOutput], ServerLog]:
+        """search の結果を cache_dir に保存し、同じ設定・クエリではそれを返す。"""
+        key_source = json.dumps(
+            {"version": _SEARCH_CACHE_VERSION, "workflow": self.model_dump(), "query": query},
+            sort_keys=True,
+            default=repr,
+        )
+        path = Path(cache_dir) / f"{hashlib.blake2b(key_source.encode()).hexdigest()}.pkl"
+        try:
+            with path.open("rb") as f:
+                return cast(tuple[NodeOutput, list[NodeOutput], ServerLog], pickle.load(f))
+        except FileNotFoundError:
+            pass
+        except (pickle.UnpicklingError, EOFError, AttributeError):
+            # 壊れた・古い形式のファイルはミス扱いにし、再計算して上書きする
+            pass
+
+        result = self.search(query)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(result, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return result
+
+    async def search_async(self, query: Any) -> tuple[NodeOutput, list[NodeOutput], ServerLog]:
+        """依存関係のないノードをスレッドで並行実行する。
+
+        search と同じ単位（search_batch でまとめるノード群）で実行し、同じサーバーを使うノードは追加順に実行するため、
+        結果・trace・log は search と同じになる。
+        """
+        assert self._nodes, "no nodes in workflow"
+        batches = self._search_batches(self._nodes)
+        outputs: dict[str, NodeOutput] = {}
+        batch_logs: dict[str, ServerLog] = {}
+        sent = set[tuple[str, str, str]]()
+        interned = dict[str, str]()
+        pending = batches
+        while pending:
+            ready = self._ready_batches(pending, outputs)
+            if not ready:
+                raise KeyError(f"unresolvable from_nodes: {pending[0][0].from_nodes}")
+            logs = [ServerLog() for _ in ready]
+            results = await asyncio.gather(
+                *(
+                    asyncio.to_thread(self._exec_batch, batch, query, outputs, batch_log, sent, interned)
+                    for batch, batch_log in zip(ready, logs)
+                )
+            )
+            for batch, outs, batch_log in zip(ready, results, logs):
+                for out in outs:
+                    outputs[out.node_name] = out
+                batch_logs[batch[0].name] = batch_log
+            pending = [batch for batch in pending if batch[0].name not in outputs]
+
+        # 並行実行の完了順に依らず、ノードの追加順に並べ直す
+        trace = [outputs[n.name] for n in self._nodes]
+        log = ServerLog()
+        for batch in batches:
+            log.merge(batch_logs[batch[0].name])
+        return trace[-1], trace, log
+
+    def search_stream(self, queries: Iterable[Any]) -> Iterator[tuple[NodeOutput, list[NodeOutput], ServerLog]]:
+        """ステージ毎にスレッドを立て、複数クエリをパイプライン実行する。
+
+        ステージ i が t 番目のクエリを処理している間に、ステージ i-1 は t+1 番目のクエリを処理する。
+        同じサーバーを使うノードは同じステージにまとめるため、各サーバーへの呼び出し順は search と同じになる。
+        結果はクエリの順に返す。
+        """
+        assert self._nodes, "no nodes in workflow"
+        stages = self._pipeline_stages()
+        channels: list[queue.Queue[object]] = [queue.Queue(maxsize=2) for _ in range(len(stages) + 1)]
+        stop = threading.Event()
+
+        def feed() -> None:
+            try:
+                for query in queries:
+                    if stop.is_set():
+                        break
+                    channels[0].put(_StreamItem(query, {}, ServerLog(), set(), {}))
+            except BaseException as e:
+                channels[0].put(e)
+            channels[0].put(_STREAM_END)
+
+        def run_stage(nodes: list[SearchNode], in_q: queue.Queue[object], out_q: queue.Queue[object]) -> None:
+            failed = False
+            while (item := in_q.get()) is not _STREAM_END:
+                # 失敗後は上流が詰まらないよう読み捨てる
+                if failed:
+                    continue
+                if isinstance(item, _StreamItem):
+                    try:
+                        for batch in self._search_batches(nodes):
+                            outs = self._exec_batch(
+                                batch, item.query, item.trace_index, item.log, item.sent, item.interned
+                            )
+                            for out in outs:
+                                item.trace_index[out.node_name] = out
+                    except BaseException as e:
+                        item = e
+                if isinstance(item, BaseException):
+                    failed = True
+                    stop.set()
+                out_q.put(item)
+            out_q.put(_STREAM_END)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads.extend(
+            threading.Thread(target=run_stage, args=(nodes, channels[i], channels[i + 1]), daemon=True)
+            for i, nodes in enumerate(stages)
+        )
+        for thread in threads:
+            thread.start()
+
+        item: object = None
+        try:
+            while (item := channels[-1].get()) is not _STREAM_END:
+                if isinstance(item, BaseException):
+                    raise item
+                assert isinstance(item, _StreamItem)
+                trace = list(item.trace_index.values())
+                yield trace[-1], trace, item.log
+        finally:
+            stop.set()
+            while item is not _STREAM_END:
+                item = channels[-1].get()
+            for thread in threads:
+                thread.join()
+
+    def _pipeline_stages(self) -> list[list[SearchNode]]:
+        # サーバーの最初のノードから最後のノードまでを 1 ステージにまとめ、
+        # 別スレッドから同じサーバーがクエリを跨いで呼ばれないようにする
+        last_index = {node.server_name: i for i, node in enumerate(self._nodes)}
+        stages = list[list[SearchNode]]()
+        end = -1
+        for i, node in enumerate(self._nodes):
+            if i > end:
+                stages.append([])
+            stages[-1].append(node)
+            end = max(end, last_index[node.server_name])
+        return stages
+
+    @staticmethod
+    def _ready_batches(pending: Sequence[list[SearchNode]], outputs: dict[str, NodeOutput]) -> list[list[SearchNode]]:
+        # バッチの後続ノードは from_nodes を持たないため、先頭ノードの依存だけを見ればよい
+        ready = list[list[SearchNode]]()
+        blocked_servers = set[str]()
+        for batch in pending:
+            head = batch[0]
+            if head.server_name not in blocked_servers and all(name in outputs for name in head.from_nodes):
+                ready.append(batch)
+            # 先行ノードが未完了のサーバーは後続ノードも待たせる
+            blocked_servers.add(head.server_name)
+        return ready
+
     def model_dump(self) -> WorkflowConfig:
         return {
             "servers": [server.model_dump() for server in self._servers.values()],
@@ -190,10 +564,16 @@ class Workflow:
             raise TypeError("nodes/servers must be list")
 
         servers_dict: dict[str, SearchServer] = {}
+        # 同じ種別のサーバーが多数ある設定向けに、レジストリ参照を種別毎に 1 回にする
+        server_classes: dict[str, type[SearchServer]] = {}
         for server_cfg in server_configs:
             if not isinstance(server_cfg, dict):
                 raise TypeError("server must be dict")
-            server = ServerRegistry.get(server_cfg["type"]).load_from_config(cast(ServerConfig, server_cfg))
+            server_type = server_cfg["type"]
+            server_cls = server_classes.get(server_type)
+            if server_cls is None:
+                server_cls = server_classes[server_type] = ServerRegistry.get(server_type)
+            server = server_cls.load_from_config(cast(ServerConfig, server_cfg))
             assert server.name not in servers_dict, f"duplicate server name: {server.name}"
             servers_dict[server.name] = server
         workflow = cls()
@@ -209,27 +589,184 @@ class Workflow:
             )
         return workflow
 
-    def _gather_entries_from_previous_nodes(self, trace: list[NodeOutput], node_names: Sequence[str]) -> list[Entry]:
-        found_entries = list[Entry]()
-        name_to_trace_node = {n.node_name: n for n in trace}
-        for node_name in node_names:
-            previous_node = name_to_trace_node[node_name]
-            for hit in previous_node.hits:
-                found_entries.append(
-                    Entry(
-                        source_server=previous_node.server_name,
-                        source_id=hit.doc_id,
-                        payload=hit.payload,
-                    )
-                )
-        return found_entries
+    def _gather_entries_from_previous_nodes(
+        self, trace_index: Mapping[str, NodeOutput], node_names: Sequence[str]
+    ) -> list[Entry]:
+        return [
+            Entry(source_server=previous_node.server_name, source_id=doc_id, payload=payload)
+            for previous_node in (trace_index[node_name] for node_name in node_names)
+            for doc_id, payload in zip(previous_node.doc_ids, previous_node.payloads)
+        ]
+
+    def _stage_cache_key(self, node: SearchNode, query: Any, entries: Sequence[Entry]) -> bytes:
+        # サーバー設定も含めることで、設定の異なるサーバーの結果を返さないようにする
+        material = (
+            self._server_digests[node.server_name],
+            node.name,
+            node.server_name,
+            node.topk,
+            query,
+            tuple((e["source_server"], e["source_id"]) for e in entries),
+        )
+        return hashlib.blake2b(repr(material).encode()).digest()
+
+    def _exec_search(
+        self,
+        node: SearchNode,
+        query: Any,
+        trace_index: Mapping[str, NodeOutput],
+        log: ServerLog,
+        sent: set[tuple[str, str, str]] | None = None,
+        interned: dict[str, str] | None = None,
+    ) -> NodeOutput:
+        cached, cache_key, adding = self._prepare_search(node, query, trace_index, log, sent)
+        if cached is not None:
+            return cached
 
-    def _exec_search(self, node: SearchNode, query: Any, trace: list[NodeOutput], log: ServerLog) -> NodeOutput:
         server = self._servers[node.server_name]
-        entries_from_previous_nodes = self._gather_entries_from_previous_nodes(trace, node.from_nodes)
+        try:
+            hits = server.search(query, topk=node.topk)
+        except BaseException:
+            # 登録の完了を待った上で、search の例外を優先して送出する
+            if adding is not None:
+                wait([adding])
+            raise
+        if adding is not None:
+            adding.result()
+        log.actions.append(
+            ServerAction(
+                node.name,
+                server.name,
+                "search",
+                {
+                    "query": query,
+                    "topk": node.topk,
+                },
+            )
+        )
+        return self._finish_search(node, hits, cache_key, interned)
+
+    def _exec_batch(
+        self,
+        batch: Sequence[SearchNode],
+        query: Any,
+        trace_index: Mapping[str, NodeOutput],
+        log: ServerLog,
+        sent: set[tuple[str, str, str]],
+        interned: dict[str, str],
+    ) -> list[NodeOutput]:
+        if len(batch) > 1 and hasattr(self._servers[batch[0].server_name], "search_batch"):
+            return self._exec_search_batch(batch, query, trace_index, log, sent, interned)
+        return [self._exec_search(node, query, trace_index, log, sent, interned) for node in batch]
+
+    def _exec_search_batch(
+        self,
+        nodes: Sequence[SearchNode],
+        query: Any,
+        trace_index: Mapping[str, NodeOutput],
+        log: ServerLog,
+        sent: set[tuple[str, str, str]],
+        interned: dict[str, str],
+    ) -> list[NodeOutput]:
+        server = cast(BatchSearchServer, self._servers[nodes[0].server_name])
+        outputs: dict[str, NodeOutput] = {}
+        pending = list[tuple[SearchNode, bytes | None]]()
+        addings = list[Future[None]]()
+        hits_list = list[list[SearchHit]]()
+        try:
+            for node in nodes:
+                cached, cache_key, adding = self._prepare_search(node, query, trace_index, log, sent)
+                if adding is not None:
+                    addings.append(adding)
+                if cached is not None:
+                    outputs[node.name] = cached
+                else:
+                    pending.append((node, cache_key))
+            if pending:
+                hits_list = server.search_batch([query] * len(pending), [node.topk for node, _ in pending])
+        except BaseException:
+            # 登録の完了を待った上で、search_batch 等の例外を優先して送出する
+            wait(addings)
+            raise
+        for adding in addings:
+            adding.result()
+        if pending:
+            log.actions.append(
+                ServerAction(
+                    pending[0][0].name,
+                    server.name,
+                    "search_batch",
+                    {
+                        "nodes": [node.name for node, _ in pending],
+                        "query": query,
+                        "topks": [node.topk for node, _ in pending],
+                        "count": len(pending),
+                    },
+                )
+            )
+            for (node, cache_key), hits in zip(pending, hits_list, strict=True):
+                outputs[node.name] = self._finish_search(node, hits, cache_key, interned)
+        return [outputs[node.name] for node in nodes]
 
-        if entries_from_previous_nodes:
-            server.add_entries(entries_from_previous_nodes)
+    def _prepare_search(
+        self,
+        node: SearchNode,
+        query: Any,
+        trace_index: Mapping[str, NodeOutput],
+        log: ServerLog,
+        sent: set[tuple[str, str, str]] | None,
+    ) -> tuple[NodeOutput | None, bytes | None, Future[None] | None]:
+        """上流のエントリを追加し、キャッシュがあればそれを返す。
+
+        add_entries_async を持つサーバーでは登録を開始し、その Future を返す。
+        """
+        server = self._servers[node.server_name]
+        entries_from_previous_nodes = self._gather_entries_from_previous_nodes(trace_index, node.from_nodes)
+
+        cache_key: bytes | None = None
+        if self._stage_cache is not None:
+            cache_key = self._stage_cache_key(node, query, entries_from_previous_nodes)
+            cached = self._stage_cache.get(cache_key)
+            if cached is not None:
+                log.cache_hits += 1
+                log.actions.append(
+                    ServerAction(
+                        node.name,
+                        server.name,
+                        "cache_hit",
+                        {
+                            "query": query,
+                            "topk": node.topk,
+                        },
+                    )
+                )
+                return cached, cache_key, None
+            log.cache_misses += 1
+
+        # 1 回の検索内で同じサーバーに送信済みのエントリは送らない
+        if sent is None:
+            sent = set()
+        new_entries = list[Entry]()
+        for entry in entries_from_previous_nodes:
+            sent_key = (server.name, entry["source_server"], entry["source_id"])
+            if sent_key not in sent:
+                sent.add(sent_key)
+                new_entries.append(entry)
+
+        adding: Future[None] | None = None
+        if new_entries:
+            if hasattr(server, "add_entries_async"):
+                ingest_server = cast(AsyncIngestServer, server)
+                adding = ingest_server.add_entries_async(new_entries)
+                if hasattr(ingest_server, "barrier"):
+                    try:
+                        ingest_server.barrier()
+                    except BaseException:
+                        # 登録を放置しないよう完了を待ってから barrier の例外を送出する
+                        wait([adding])
+                        raise
+            else:
+                server.add_entries(new_entries)
             log.actions.append(
                 ServerAction(
                     node.name,
@@ -237,35 +774,40 @@ class Workflow:
                     "add_entries",
                     {
                         "from_nodes": list(node.from_nodes),
-                        "count": len(entries_from_previous_nodes),
+                        "count": len(new_entries),
                     },
                 )
             )
 
-        hits = server.search(query, topk=node.topk)
-        log.actions.append(
-            ServerAction(
-                node.name,
-                server.name,
-                "search",
-                {
-                    "query": query,
-                    "topk": node.topk,
-                },
-            )
-        )
-        return NodeOutput(
-            node_name=node.name,
-            server_name=server.name,
-            hits=hits,
+        return None, cache_key, adding
+
+    def _finish_search(
+        self,
+        node: SearchNode,
+        hits: Sequence[SearchHit],
+        cache_key: bytes | None,
+        interned: dict[str, str] | None = None,
+    ) -> NodeOutput:
+        # 1 回の検索内でノード間を流れる同じ doc_id は同じ文字列オブジェクトを共有する（str 以外はそのまま）
+        if interned is None:
+            interned = {}
+        out = NodeOutput(
+            node.name,
+            node.server_name,
+            doc_ids=[interned.setdefault(d, d) if type(d) is str else d for d in (hit.doc_id for hit in hits)],
+            scores=array.array("d", [hit.score for hit in hits]),
+            payloads=[hit.payload for hit in hits],
         )
+        if cache_key is not None and self._stage_cache is not None:
+            self._stage_cache.put(cache_key, out)
+        return out
 
 
 def show_trace(trace: list[NodeOutput], log: ServerLog) -> str:
     lines: list[str] = ["===== Node Outputs ====="]
     for node_output in trace:
         name = node_output.node_name
-        rows = ", ".join(f"{hit.doc_id}:{hit.score:.3f}" for hit in node_output.hits)
+        rows = ", ".join(f"{doc_id}:{score:.3f}" for doc_id, score in zip(node_output.doc_ids, node_output.scores))
         lines.append(f"{name} -> [{rows}]")
     lines.append("\n===== Actions =====")
     for action in log.actions:
@@ -1,3 +1,9 @@
+import asyncio
+import dataclasses
+import pickle
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import pytest
 from typing import Any
 from lazy_rag.framework.multi_stage_search import (
@@ -63,6 +69,23 @@ def test_searchnode_load_from_config_valid():
     assert node.from_nodes == ["prev"]
 
 
+@pytest.mark.parametrize(
+    "override",
+    [
+        {"topk": "5"},
+        {"topk": True},
+        {"from_nodes": "prev"},
+        {"from_nodes": ["prev", 1]},
+        {"name": 1},
+        {"server_name": None},
+    ],
+)
+def test_searchnode_load_from_config_invalid(override):
+    cfg = {"name": "n1", "server_name": "s1", "topk": 5, "from_nodes": ["prev"], **override}
+    with pytest.raises(TypeError):
+        SearchNode.load_from_config(cfg)
+
+
 def test_server_registry_register_and_get():
     ServerRegistry.register("dummy", DummyServer)
     cls = ServerRegistry.get("dummy")
@@ -100,15 +123,434 @@ def test_exec_search_with_from_nodes():
     node2 = SearchNode("n2", "s2", topk=1, from_nodes=["n1"])
     wf._nodes = [node1, node2]
 
-    trace: list[NodeOutput] = []
+    trace_index: dict[str, NodeOutput] = {}
     log = ServerLog()
 
     # 1段目
-    out1 = wf._exec_search(node1, "hello", trace, log)
-    trace.append(out1)
+    out1 = wf._exec_search(node1, "hello", trace_index, log)
+    trace_index[out1.node_name] = out1
 
     # 2段目（from_nodes 経由で add_entries 呼ばれる）
-    out2 = wf._exec_search(node2, "world", trace, log)
+    out2 = wf._exec_search(node2, "world", trace_index, log)
     assert server2._entries  # エントリ追加されている
     assert any(a.op == "add_entries" for a in log.actions)
     assert any(a.op == "search" for a in log.actions)
+
+
+def test_workflow_search_stage_cache():
+    server1 = DummyServer("s1", "dummy")
+    server2 = DummyServer("s2", "dummy")
+    wf = Workflow(cache=True)
+    wf.add(server1, node_name="n1", from_nodes=[], topk=2)
+    wf.add(server2, node_name="n2", from_nodes=["n1"], topk=2)
+
+    out1, _, log1 = wf.search("query")
+    assert log1.cache_misses == 2 and log1.cache_hits == 0
+
+    # 同じクエリの再実行ではサーバーを呼ばずにキャッシュから返す
+    out2, _, log2 = wf.search("query")
+    assert log2.cache_hits == 2 and log2.cache_misses == 0
+    assert [a.op for a in log2.actions] == ["cache_hit", "cache_hit"]
+    assert out2 == out1
+    assert len(server1._queries) == 1
+    assert len(server2._queries) == 1
+    assert len(server2._entries) == 2
+
+    # クエリが変われば再検索される
+    _, _, log3 = wf.search("other")
+    assert log3.cache_misses == 2
+    assert len(server1._queries) == 2
+
+
+def test_workflow_search_stage_cache_returns_copies():
+    wf = Workflow(cache=True)
+    wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+
+    # キャッシュに入れた結果を書き換えてもキャッシュは変わらない
+    out, _, _ = wf.search("q")
+    out.doc_ids.reverse()
+    out.scores[0] = 0.0
+    hit, _, log = wf.search("q")
+    assert log.cache_hits == 1
+    assert hit.doc_ids == ["s1-0", "s1-1"]
+    assert list(hit.scores) == [1.0, 0.9]
+
+    # キャッシュから返した結果を書き換えても次のヒットは変わらない
+    hit.doc_ids.clear()
+    assert wf.search("q")[0].doc_ids == ["s1-0", "s1-1"]
+
+
+def test_workflow_search_stage_cache_is_bounded():
+    server = DummyServer("s1", "dummy")
+    wf = Workflow(cache=True, cache_size=2)
+    wf.add(server, node_name="n1", from_nodes=[], topk=1)
+    for query in ["q1", "q2", "q3"]:
+        wf.search(query)
+    assert len(wf._stage_cache) == 2
+
+    # 最も古い q1 は追い出されている
+    _, _, log = wf.search("q1")
+    assert log.cache_misses == 1
+    _, _, log = wf.search("q3")
+    assert log.cache_hits == 1
+
+
+def test_workflow_search_without_cache():
+    # 既定ではキャッシュしない
+    server = DummyServer("s1", "dummy")
+    wf = Workflow()
+    wf.add(server, node_name="n1", from_nodes=[], topk=1)
+    wf.search("query")
+    _, _, log = wf.search("query")
+    assert log.cache_hits == 0 and log.cache_misses == 0
+    assert len(server._queries) == 2
+
+
+def test_workflow_search_async_matches_search():
+    def build() -> Workflow:
+        wf = Workflow(cache=False)
+        wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+        wf.add(DummyServer("s2", "dummy"), node_name="n2", from_nodes=[], topk=2)
+        wf.add(DummyServer("s3", "dummy"), node_name="n3", from_nodes=["n1", "n2"], topk=3)
+        return wf
+
+    out, trace, log = build().search("query")
+    async_out, async_trace, async_log = asyncio.run(build().search_async("query"))
+    assert async_out == out
+    assert async_trace == trace
+    assert async_log == log
+
+
+def test_ready_batches_serializes_same_server():
+    n1 = SearchNode("n1", "s1")
+    n2 = SearchNode("n2", "s2")
+    n3 = SearchNode("n3", "s1")
+    n4 = SearchNode("n4", "s3", from_nodes=["n1"])
+    ready = Workflow._ready_batches([[n1], [n2], [n3], [n4]], {})
+    assert ready == [[n1], [n2]]
+
+
+def test_workflow_search_stream():
+    def build() -> Workflow:
+        wf = Workflow(cache=False)
+        wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+        wf.add(DummyServer("s2", "dummy"), node_name="n2", from_nodes=["n1"], topk=3)
+        return wf
+
+    queries = ["q1", "q2", "q3"]
+    expected = [build().search(q) for q in queries]
+    results = list(build().search_stream(iter(queries)))
+    assert [out for out, _, _ in results] == [out for out, _, _ in expected]
+    assert [trace for _, trace, _ in results] == [trace for _, trace, _ in expected]
+
+
+def test_workflow_search_stream_propagates_error():
+    class FailingServer(DummyServer):
+        def search(self, query: str, topk: int) -> list[SearchHit]:
+            if query == "bad":
+                raise RuntimeError("boom")
+            return super().search(query, topk)
+
+    wf = Workflow(cache=False)
+    wf.add(FailingServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=1)
+    wf.add(DummyServer("s2", "dummy"), node_name="n2", from_nodes=["n1"], topk=1)
+    stream = wf.search_stream(["ok", "bad", "ok"])
+    assert next(stream)[0].node_name == "n2"
+    with pytest.raises(RuntimeError, match="boom"):
+        next(stream)
+
+
+def test_node_output_from_hits_roundtrip():
+    hits = [SearchHit(doc_id="a", score=0.5, payload={"k": 1}), SearchHit(doc_id="b", score=0.25)]
+    out = NodeOutput.from_hits(node_name="n1", server_name="s1", hits=hits)
+    assert out.doc_ids == ["a", "b"]
+    assert list(out.scores) == [0.5, 0.25]
+    assert out.hits == hits
+
+
+def test_workflow_model_dump_roundtrip():
+    ServerRegistry.register("dummy", DummyServer)
+    wf = Workflow()
+    wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+    wf.add(DummyServer("s2", "dummy"), node_name="n2", from_nodes=["n1"], topk=3)
+    wf.add(DummyServer("s3", "dummy"), node_name="n3", from_nodes=["n1", "n2"], topk=1)
+
+    config = wf.model_dump()
+    loaded = Workflow.load_from_config(config)
+    assert loaded.model_dump() == config
+
+
+def test_workflow_search_interns_doc_ids():
+    wf = Workflow()
+    wf.add(QueryServer("a", "dummy"), node_name="a", from_nodes=[], topk=1)
+    wf.add(QueryServer("b", "dummy"), node_name="b", from_nodes=[], topk=1)
+    _, trace, _ = wf.search("q")
+    # 別々に生成された同じ doc_id が 1 回の検索内で共有される
+    assert trace[0].doc_ids[0] == "q-0"
+    assert trace[0].doc_ids[0] is trace[1].doc_ids[0]
+
+
+def test_workflow_add_validation():
+    wf = Workflow()
+    wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=1)
+    with pytest.raises(AssertionError, match="duplicate node name"):
+        wf.add(DummyServer("s2", "dummy"), node_name="n1", from_nodes=[], topk=1)
+    with pytest.raises(AssertionError, match="must implement SearchServer"):
+        wf.add(object(), node_name="n2", from_nodes=[], topk=1)  # type: ignore[arg-type]
+
+
+def test_workflow_search_cached(tmp_path):
+    def build() -> tuple[Workflow, DummyServer]:
+        server = DummyServer("s1", "dummy")
+        wf = Workflow()
+        wf.add(server, node_name="n1", from_nodes=[], topk=2)
+        return wf, server
+
+    wf, server = build()
+    out, trace, _ = wf.search_cached("query", cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.pkl"))) == 1
+
+    # 別プロセス相当の新しいワークフローでもディスクから返る
+    wf2, server2 = build()
+    out2, trace2, _ = wf2.search_cached("query", cache_dir=tmp_path)
+    assert out2 == out and trace2 == trace
+    assert server2._queries == []
+
+    wf2.search_cached("other", cache_dir=tmp_path)
+    assert server2._queries == [("other", 2)]
+
+
+def test_workflow_search_skips_already_sent_entries():
+    server1 = DummyServer("s1", "dummy")
+    server2 = DummyServer("s2", "dummy")
+    wf = Workflow(cache=False)
+    wf.add(server1, node_name="n1", from_nodes=[], topk=2)
+    wf.add(server2, node_name="n2", from_nodes=["n1"], topk=1)
+    wf.add(server2, node_name="n3", from_nodes=["n1"], topk=1)
+
+    _, _, log = wf.search("query")
+    # n3 は n2 と同じサーバー・同じ上流なので add_entries を呼ばない
+    assert len(server2._entries) == 2
+    assert [(a.node, a.op) for a in log.actions] == [
+        ("n1", "search"),
+        ("n2", "add_entries"),
+        ("n2", "search"),
+        ("n3", "search"),
+    ]
+
+
+def test_searchhit_default_payload_is_shared():
+    hit1 = SearchHit(doc_id="a", score=1.0)
+    hit2 = SearchHit(doc_id="b", score=0.5)
+    assert hit1.payload is hit2.payload
+    assert hit1.payload == {}
+    assert pickle.loads(pickle.dumps(hit1)).payload is hit1.payload
+
+
+class BatchDummyServer(DummyServer):
+    """search_batch を持つモック"""
+
+    def __init__(self, name: str, stype: str):
+        super().__init__(name, stype)
+        self._batches: list[tuple[list[str], list[int]]] = []
+
+    def search_batch(self, queries: list[str], topks: list[int]) -> list[list[SearchHit]]:
+        self._batches.append((list(queries), list(topks)))
+        return [super(BatchDummyServer, self).search(q, k) for q, k in zip(queries, topks)]
+
+
+def test_workflow_search_batches_same_server_nodes():
+    def build(server1: DummyServer) -> Workflow:
+        wf = Workflow(cache=False)
+        wf.add(server1, node_name="n1", from_nodes=[], topk=1)
+        wf.add(server1, node_name="n2", from_nodes=[], topk=2)
+        wf.add(DummyServer("s2", "dummy"), node_name="n3", from_nodes=["n1", "n2"], topk=1)
+        return wf
+
+    batch_server = BatchDummyServer("s1", "dummy")
+    out, trace, log = build(batch_server).search("query")
+    assert batch_server._batches == [(["query", "query"], [1, 2])]
+    assert [(a.node, a.op) for a in log.actions] == [("n1", "search_batch"), ("n3", "add_entries"), ("n3", "search")]
+    assert log.actions[0].detail["nodes"] == ["n1", "n2"]
+    assert log.actions[0].detail["count"] == 2
+
+    # search_batch を持たないサーバーと同じ結果になる
+    expected_out, expected_trace, _ = build(DummyServer("s1", "dummy")).search("query")
+    assert out == expected_out
+    assert trace == expected_trace
+
+    # search_async / search_stream も同じ単位でまとめて検索する
+    async_server = BatchDummyServer("s1", "dummy")
+    async_result = asyncio.run(build(async_server).search_async("query"))
+    assert async_result == (out, trace, log)
+    assert async_server._batches == [(["query", "query"], [1, 2])]
+
+    stream_server = BatchDummyServer("s1", "dummy")
+    (stream_result,) = build(stream_server).search_stream(["query"])
+    assert stream_result == (out, trace, log)
+    assert stream_server._batches == [(["query", "query"], [1, 2])]
+
+
+class AsyncIngestDummyServer(DummyServer):
+    """登録が遅れて反映される（結果整合性のある）サーバーのモック"""
+
+    def __init__(
+        self, name: str, stype: str, fail: bool = False, barrier_error: bool = False, search_error: bool = False
+    ):
+        super().__init__(name, stype)
+        self._fail = fail
+        self._barrier_error = barrier_error
+        self._search_error = search_error
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cond = threading.Condition()
+        self._issued = 0
+        self._applied = 0
+        self.futures: list[Future[None]] = []
+
+    def add_entries_async(self, entries: list[Entry]) -> Future[None]:
+        with self._cond:
+            self._issued += 1
+
+        def write() -> None:
+            time.sleep(0.005)
+            try:
+                if self._fail:
+                    raise RuntimeError("add failed")
+                self._entries.extend(entries)
+            finally:
+                with self._cond:
+                    self._applied += 1
+                    self._cond.notify_all()
+
+        future = self._executor.submit(write)
+        self.futures.append(future)
+        return future
+
+    def barrier(self) -> None:
+        if self._barrier_error:
+            raise RuntimeError("barrier failed")
+        with self._cond:
+            self._cond.wait_for(lambda: self._applied >= self._issued, timeout=5)
+
+    def search(self, query: str, topk: int) -> list[SearchHit]:
+        if self._search_error:
+            raise ValueError("search failed")
+        return [SearchHit(doc_id=e["source_id"], score=1.0) for e in self._entries[:topk]]
+
+
+def build_async_ingest_workflow(server: DummyServer) -> Workflow:
+    wf = Workflow()
+    wf.add(DummyServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+    wf.add(server, node_name="n2", from_nodes=["n1"], topk=2)
+    return wf
+
+
+def test_workflow_search_add_entries_async_with_barrier():
+    for _ in range(20):
+        server = AsyncIngestDummyServer("s2", "dummy")
+        out, _, log = build_async_ingest_workflow(server).search("query")
+        # barrier により search は登録済みのエントリを参照する
+        assert out.doc_ids == ["s1-0", "s1-1"]
+        assert [a.op for a in log.actions] == ["search", "add_entries", "search"]
+
+
+def test_workflow_search_propagates_add_entries_async_error():
+    wf = build_async_ingest_workflow(AsyncIngestDummyServer("s2", "dummy", fail=True))
+    with pytest.raises(RuntimeError, match="add failed"):
+        wf.search("query")
+
+
+def test_workflow_search_joins_add_entries_async_when_barrier_fails():
+    server = AsyncIngestDummyServer("s2", "dummy", barrier_error=True)
+    with pytest.raises(RuntimeError, match="barrier failed"):
+        build_async_ingest_workflow(server).search("query")
+    assert all(future.done() for future in server.futures)
+
+
+class QueryServer(DummyServer):
+    """クエリ毎に異なる doc_id を返すモック"""
+
+    def search(self, query: str, topk: int) -> list[SearchHit]:
+        return [SearchHit(doc_id=f"{query}-{i}", score=1.0 - i * 0.1) for i in range(topk)]
+
+
+class RerankServer(DummyServer):
+    """直前の add_entries で受け取ったエントリだけを返す状態付きモック"""
+
+    def add_entries(self, entries: list[Entry]) -> None:
+        self._entries = list(entries)
+
+    def search(self, query: str, topk: int) -> list[SearchHit]:
+        time.sleep(0.001)
+        hits = [SearchHit(doc_id=e["source_id"], score=1.0) for e in self._entries[:topk]]
+        self._entries = []
+        return hits
+
+
+def test_workflow_search_stream_shared_server():
+    def build() -> Workflow:
+        rerank = RerankServer("r", "dummy")
+        wf = Workflow()
+        wf.add(QueryServer("a", "dummy"), node_name="a", from_nodes=[], topk=1)
+        wf.add(rerank, node_name="b", from_nodes=["a"], topk=1)
+        wf.add(QueryServer("c", "dummy"), node_name="c", from_nodes=["b"], topk=1)
+        wf.add(rerank, node_name="d", from_nodes=["c"], topk=1)
+        return wf
+
+    queries = [f"q{i}" for i in range(8)]
+    wf = build()
+    assert [[n.name for n in stage] for stage in wf._pipeline_stages()] == [["a"], ["b", "c", "d"]]
+
+    expected = [build().search(q)[1] for q in queries]
+    results = [trace for _, trace, _ in wf.search_stream(queries)]
+    assert results == expected
+    assert [trace[-1].doc_ids for trace in results] == [[f"q{i}-0"] for i in range(8)]
+
+
+def test_node_output_constructors():
+    hits = [SearchHit(doc_id="a", score=0.5)]
+    out = NodeOutput("n1", "s1", hits)
+    assert out == NodeOutput.from_hits("n1", "s1", hits)
+    assert out == NodeOutput(node_name="n1", server_name="s1", hits=hits)
+    assert dataclasses.replace(out, node_name="n2").node_name == "n2"
+    assert pickle.loads(pickle.dumps(out)) == out
+    with pytest.raises(TypeError):
+        NodeOutput("n1", "s1")
+    with pytest.raises(TypeError):
+        NodeOutput("n1", "s1", hits, doc_ids=["a"])
+
+
+def test_node_output_keeps_non_str_doc_ids():
+    out = NodeOutput.from_hits("n1", "s1", [SearchHit(doc_id=1, score=1.0)])  # type: ignore[arg-type]
+    assert out.doc_ids == [1]
+
+    class IntIdServer(DummyServer):
+        def search(self, query: str, topk: int) -> list[SearchHit]:
+            return [SearchHit(doc_id=i, score=1.0) for i in range(topk)]  # type: ignore[arg-type]
+
+    wf = Workflow()
+    wf.add(IntIdServer("s1", "dummy"), node_name="n1", from_nodes=[], topk=2)
+    assert wf.search("q")[0].doc_ids == [0, 1]
+
+
+def test_workflow_search_cached_recovers_from_corrupt_file(tmp_path):
+    server = DummyServer("s1", "dummy")
+    wf = Workflow()
+    wf.add(server, node_name="n1", from_nodes=[], topk=1)
+    out, _, _ = wf.search_cached("query", cache_dir=tmp_path)
+    (path,) = tmp_path.glob("*.pkl")
+
+    # 途中で切れたファイルは再計算して書き直す
+    path.write_bytes(path.read_bytes()[:10])
+    out2, _, _ = wf.search_cached("query", cache_dir=tmp_path)
+    assert out2 == out
+    assert len(server._queries) == 2
+    with path.open("rb") as f:
+        assert pickle.load(f)[0] == out
+
+
+def test_workflow_search_prefers_search_error_over_add_entries_async_error():
+    server = AsyncIngestDummyServer("s2", "dummy", fail=True, search_error=True)
+    with pytest.raises(ValueError, match="search failed"):
+        build_async_ingest_workflow(server).search("query")
+    assert all(future.done() for future in server.futures)